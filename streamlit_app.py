@@ -1,12 +1,20 @@
 import streamlit as st
 import pandas as pd
-import json
 
 # Required for providing date time warning
+import functools
 from datetime import datetime
 import io
+from concurrent.futures import ThreadPoolExecutor
 from PyPDF2 import PdfReader
 
+# pypdfium2 (PDFium C++ bindings) is much faster than PyPDF2 at text
+# extraction; fall back to PyPDF2 if it isn't available in the environment
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
 # Required for Snowpark session, Cortex search, and LLM completion
 try:
     from snowflake.core import Root
@@ -30,6 +38,15 @@ MODELS = [
     "mistral-7b"
 ]
 
+# "auto" routes each task to the cheapest model that handles it well;
+# the 70B model is opt-in via an explicit sidebar selection
+MODEL_AUTO = "auto"
+_TASK_MODEL_ROUTES = {
+    "copay": "mistral-7b",
+    "coverage": "mixtral-8x7b",
+    "general": "mistral-7b",
+}
+
 # --- SESSION & INITIALIZATION ---
 
 # Get active session (required for Snowpark and Core)
@@ -44,7 +61,7 @@ root = Root(session)
 
 # Set model name default
 if "model_name" not in st.session_state:
-    st.session_state.model_name = MODELS[3]
+    st.session_state.model_name = MODEL_AUTO
 if "num_retrieved_chunks" not in st.session_state:
     st.session_state.num_retrieved_chunks = 1
 
@@ -110,7 +127,12 @@ def init_config_options():
     )
     
     with st.sidebar.expander("Model & Chunk Options"):
-        st.selectbox("Select Model:", MODELS, key="model_name")
+        st.selectbox(
+            "Select Model:",
+            [MODEL_AUTO] + MODELS,
+            key="model_name",
+            help="'auto' picks a small or mid-size model per task; choose a 70B model here to override."
+        )
         st.number_input(
             "Number of context chunks to retrieve (Top K)",
             value=1,
@@ -118,12 +140,122 @@ def init_config_options():
             min_value=1,
             max_value=10,
         )
+        st.selectbox(
+            "Reranker:",
+            ["none", "cortex"],
+            key="reranker_backend",
+            help="Oversample the retrieval and rerank with Cortex, keeping the best Top K chunks."
+        )
+
+
+@st.cache_resource
+def _get_search_service():
+    """
+    Resolve the Cortex Search service handle once per session.
+
+    The chained databases/schemas lookup hits Snowflake metadata, so
+    memoize the (non-serializable) handle with st.cache_resource instead
+    of re-resolving it on every chat turn.
+    """
+    return (
+        root.databases[DB_NAME]
+        .schemas[SCHEMA_NAME]
+        .cortex_search_services[RAG_SERVICE_NAME]
+    )
+
+
+def _build_search_filter(insurer, plan):
+    """Build the dynamic Cortex Search filter for the selected policy."""
+
+    # Start with our mandatory language filter
+    search_filters = [
+        {"@eq": {"language": "Indonesian"}}
+    ]
+
+    # Add filters ONLY if they have been selected
+    if insurer:
+        search_filters.append({"@eq": {"INSURER": insurer}})
+
+    if plan:
+        # Use '@ilike' for flexible matching (e.g., "Policy_XYZ" matches "Policy_XYZ.pdf")
+        search_filters.append({"@ilike": {"POLICY_PLAN": f"%{plan}%"}})
+
+    # Combine all filters using "@and"
+    return {"@and": search_filters}
+
+
+@st.cache_data(ttl=300)
+def _cached_search(query, insurer, plan, k, columns):
+    """
+    Run the Cortex Search query and return plain result dicts.
+
+    Cached for 5 minutes on (query, insurer, plan, k), so reruns with an
+    identical question and policy selection (e.g. a debug toggle flip)
+    skip the full retrieval round-trip.
+    """
+    context_documents = _get_search_service().search(
+        query,
+        columns=list(columns),
+        filter=_build_search_filter(insurer, plan),
+        limit=k,
+    )
+    # Convert to plain dicts so the results are pickleable for the cache
+    return [dict(r) for r in context_documents.results]
+
+
+# Retrieve this many times Top K candidates when reranking is enabled
+RERANK_OVERSAMPLE = 20
+
+
+def _reranker_enabled():
+    """Whether reranking is selected and hasn't already failed this session."""
+    return (
+        st.session_state.get("reranker_backend", "none") != "none"
+        and not st.session_state.get("_rerank_unavailable", False)
+    )
+
+
+def _rerank_results(query, results, k):
+    """
+    Rerank oversampled search results and keep the best k.
+
+    Scores each (query, chunk) pair with Cortex's AI_RERANK SQL function
+    in a single statement. If the reranker is disabled or unavailable,
+    fall back to the original vector-similarity order. A failed rerank
+    is remembered for the session so we don't re-issue a doomed query
+    (and oversampled retrieval) on every turn.
+    """
+    if len(results) <= k:
+        return results[:k]
+
+    if not _reranker_enabled():
+        return results[:k]
+
+    try:
+        import json
+
+        scored = session.sql(
+            """
+            SELECT f.index AS idx,
+                   SNOWFLAKE.CORTEX.AI_RERANK(?, f.value::string) AS score
+            FROM TABLE(FLATTEN(input => PARSE_JSON(?))) f
+            """,
+            params=[query, json.dumps([r["chunk"] for r in results])],
+        ).collect()
+        order = sorted(scored, key=lambda row: row["SCORE"], reverse=True)
+        return [results[row["IDX"]] for row in order[:k]]
+    except Exception as e:
+        # Reranker not available in this account; keep vector order and
+        # don't try again this session
+        st.session_state["_rerank_unavailable"] = True
+        st.sidebar.warning(f"Reranker unavailable, falling back to vector order: {e}")
+        return results[:k]
 
 
 def query_cortex_search_service(query, columns=["chunk", "file_url", "relative_path", "INSURER", "POLICY_PLAN", "UPLOAD_DATE", "POLICY_START_DATE"]):
     """
     Query the selected cortex search service using the Python API.
-    
+
     *** THIS FUNCTION IS NOW MODIFIED ***
     It dynamically builds a filter based on the Streamlit session state.
 
@@ -134,83 +266,167 @@ def query_cortex_search_service(query, columns=["chunk", "file_url", "relative_p
     Returns:
         tuple: The concatenated string of context documents and the list of raw results.
     """
-    
-    # 1. Access the Cortex Search Service (same as before)
+
+    # 1. Access the Cortex Search Service (cached per session)
     try:
-        cortex_search_service = (
-            root.databases[DB_NAME]
-            .schemas[SCHEMA_NAME]
-            .cortex_search_services[RAG_SERVICE_NAME]
-        )
+        _get_search_service()
     except Exception as e:
         st.error(f"Could not find Cortex Search Service '{RAG_SERVICE_NAME}'. Please ensure it exists in your schema.")
         st.stop()
-        
-    # --- 2. NEW: Build the dynamic filter ---
-    # Start with our mandatory language filter
-    search_filters = [
-        {"@eq": {"language": "Indonesian"}}
-    ]
-    
-    # Get insurer and plan from the session state
+
+    # 2. Get insurer and plan from the session state
     insurer = st.session_state.get("selected_insurer", "")
     plan = st.session_state.get("selected_plan", "")
-    
-    # Add filters ONLY if they have been selected
-    if insurer:
-        search_filters.append({"@eq": {"INSURER": insurer}})
-    
-    if plan:
-        # Use '@ilike' for flexible matching (e.g., "Policy_XYZ" matches "Policy_XYZ.pdf")
-        search_filters.append({"@ilike": {"POLICY_PLAN": f"%{plan}%"}})
 
-    # Combine all filters using "@and"
-    search_filter = {"@and": search_filters}
-    
-    # 3. Execute the search (with the new filter)
+    # 3. Execute the search (cached per query + policy selection).
+    #    When reranking, oversample the candidate pool and let the
+    #    reranker pick the best Top K.
+    top_k = st.session_state.num_retrieved_chunks
+    if _reranker_enabled():
+        limit = min(top_k * RERANK_OVERSAMPLE, 100)
+    else:
+        limit = top_k
+
     try:
-        context_documents = cortex_search_service.search(
-            query, 
-            columns=columns, 
-            filter=search_filter,  # <--- Pass the new dynamic filter
-            limit=st.session_state.num_retrieved_chunks
+        results = _cached_search(
+            query,
+            insurer,
+            plan,
+            limit,
+            tuple(columns),
         )
-        results = context_documents.results
+        results = _rerank_results(query, results, top_k)
     except Exception as e:
-        # Catch errors if the filter is bad or a column is missing
+        # Catch errors if the filter is bad or a column is missing.
+        # json is only needed on this error path, so import it lazily.
+        import json
+
         st.error(f"Error during search: {e}")
-        st.error(f"Attempted search filter: {json.dumps(search_filter, indent=2)}")
+        st.error(f"Attempted search filter: {json.dumps(_build_search_filter(insurer, plan), indent=2)}")
         st.stop()
         
-    # 4. Format the context for the LLM prompt (same as before)
-    context_str = ""
+    # 4. Format the context for the LLM prompt (same as before).
+    #    Overlapping chunks from the same page waste prompt tokens, so
+    #    drop near-duplicates by a cheap prefix key before formatting.
+    #    Accumulate into a list and join once; += on strings is O(n^2).
     search_col = "chunk" # The column containing the text
-    
+
+    seen = set()
+    deduped = []
+    for r in results:
+        key = r[search_col][:80]
+        if key not in seen:
+            seen.add(key)
+            deduped.append(r)
+    results = deduped
+
+    parts = []
     for i, r in enumerate(results):
-        context_str += f"Context document {i+1}: {r[search_col]} \n" + "\n"
+        parts.append(f"Context document {i+1}: {r[search_col]} \n")
+    context_str = "\n".join(parts)
 
     # 5. Optional: Display context and filter in debug mode
     if st.session_state.debug:
         st.sidebar.subheader("Debug Info (Search)")
         st.sidebar.text_area("Context documents", context_str, height=200)
         st.sidebar.caption("Dynamic Search Filter JSON:")
-        st.sidebar.json(search_filter)
+        st.sidebar.json(_build_search_filter(insurer, plan))
 
     return context_str, results
 
 
-def complete(model, prompt):
+def _resolve_model(current_task):
+    """
+    Pick the LLM for this turn.
+
+    Honors an explicit sidebar selection; on "auto", picks a small or
+    mid-size model per task so nobody pays 70B cost by default.
+    """
+    selected = st.session_state.get("model_name", MODEL_AUTO)
+    if selected != MODEL_AUTO:
+        return selected
+    return _TASK_MODEL_ROUTES.get(current_task, _TASK_MODEL_ROUTES["general"])
+
+
+def complete(model, prompt, stream=False):
     """
     Generate a completion for the given prompt using the specified model via the Cortex API.
+
+    The prompt may be a plain string or a list of role/content message
+    dicts. With stream=True this returns a generator of response tokens
+    instead of blocking until the full response is ready.
     """
     # Use the snowflake.cortex.Complete class wrapper
-    return Complete(model, prompt)
+    return Complete(model, prompt, stream=stream)
+
+
+# Static per-task instructions, built once at module load. These are sent
+# as the system message and never change between turns, so provider-side
+# prompt caches can reuse the tokenized prefix; only the user block below
+# carries per-turn content.
+_SYSTEM_INSTRUCTIONS = {
+    "general": """
+Anda adalah asisten cerdas yang bertugas menjawab pertanyaan tentang polis asuransi.
+Tugas Anda adalah:
+1. Jawablah PERTANYAAN user menggunakan <POLICY_CONTEXT>.
+2. Jika <PATIENT_CONTEXT> disediakan, gunakan itu untuk informasi tambahan tentang pasien.
+3. Jawablah HANYA berdasarkan informasi yang disediakan.
+4. Jika <POLICY_CONTEXT> tidak berisi jawaban, jawablah "Informasi tidak ditemukan dalam dokumen polis."
+""",
+
+    "coverage": """
+Anda adalah asisten analis perlindungan (coverage) asuransi.
+Tugas Anda adalah menentukan apakah prosedur pasien DITANGGUNG atau TIDAK DITANGGUNG.
+1. Periksa <PATIENT_CONTEXT> untuk menemukan prosedur medis yang dijalani pasien (jika ada).
+2. Periksa <POLICY_CONTEXT> untuk menentukan apakah prosedur tersebut ditanggung.
+3. Jawab HANYA dengan "DITANGGUNG" atau "TIDAK DITANGGUNG" atau "TIDAK DISEBUTKAN".
+4. Jika <CONTEXT> menyebutkan syarat, Anda tetap harus menjawab "DITANGGUNG", lalu berikan penjelasan singkat.
+""",
+
+    "copay": """
+Anda adalah asisten ekstraksi data keuangan.
+Tugas Anda adalah menemukan jumlah biaya (co-payment, iuran, deductible).
+1. Gunakan <POLICY_CONTEXT> untuk menemukan jumlah biaya.
+2. Gunakan <PATIENT_CONTEXT> untuk mengidentifikasi prosedur yang ditanyakan.
+3. Jika <POLICY_CONTEXT> tidak menyebutkan biaya spesifik, jawablah "Informasi biaya tidak ditemukan."
+4. JANGAN membuat kalimat panjang. Berikan jawaban yang spesifik.
+"""
+}
+
+# Dynamic per-turn block: retrieved context plus the user's question
+_USER_BLOCK = """
+<POLICY_CONTEXT>
+{policy_context}
+</POLICY_CONTEXT>
+{patient_context}
+
+<PERTANYAAN>
+{user_question}
+</PERTANYAAN>
+"""
+
+
+def _prompt_to_text(prompt):
+    """Flatten a role-based prompt into plain text for debug display."""
+    return "\n\n".join(m["content"] for m in prompt)
+
+
+def _trim(text, max_chars=4000):
+    """
+    Bound text to a character budget with head/tail truncation.
 
+    Keeps the start and end of the document (where patient reports carry
+    their identifying and concluding details) and drops the middle, so a
+    long upload doesn't blow the prompt-token budget on boilerplate.
+    """
+    if len(text) <= max_chars:
+        return text
+    return (
+        text[:max_chars // 2]
+        + "\n...[TRIMMED]...\n"
+        + text[-(max_chars // 2):]
+    )
 
-# In your Streamlit Python file (app.py)
-#
-# Replace your OLD create_prompt function
-# with this NEW one.
 
 def create_prompt(user_question):
     """
@@ -235,9 +451,15 @@ def create_prompt(user_question):
     uploaded_file = st.session_state.get("patient_file_uploader")
     
     if uploaded_file:
-        # Use our new helper function to get the text
-        patient_context = get_text_from_uploaded_pdf(uploaded_file)
-        
+        # Parse only when a different file is uploaded; task-button
+        # clicks and config changes reuse the text from session state
+        fid = uploaded_file.file_id
+        if st.session_state.get("_patient_text_fid") != fid:
+            st.session_state["patient_text"] = get_text_from_uploaded_pdf(uploaded_file)
+            st.session_state["_patient_text_fid"] = fid
+        # Trim to a token budget before embedding in the prompt
+        patient_context = _trim(st.session_state["patient_text"])
+
         # Add headers for the LLM to understand
         patient_context = f"""
             <PATIENT_CONTEXT>
@@ -249,75 +471,25 @@ def create_prompt(user_question):
     # 3. Get the current task from the session state
     current_task = st.session_state.get("current_task", "general")
 
-    # 4. Define our new DUAL-CONTEXT prompt templates
-    #    (Each template is updated to include the {patient_context})
-    prompt_templates = {
-        "general": f"""
-        [INST]
-        Anda adalah asisten cerdas yang bertugas menjawab pertanyaan tentang polis asuransi.
-        Tugas Anda adalah:
-        1. Jawablah PERTANYAAN user menggunakan <POLICY_CONTEXT>.
-        2. Jika <PATIENT_CONTEXT> disediakan, gunakan itu untuk informasi tambahan tentang pasien.
-        3. Jawablah HANYA berdasarkan informasi yang disediakan.
-        4. Jika <POLICY_CONTEXT> tidak berisi jawaban, jawablah "Informasi tidak ditemukan dalam dokumen polis."
-        
-        <POLICY_CONTEXT>
-        {policy_context}
-        </POLICY_CONTEXT>
-        {patient_context}
-        
-        <PERTANYAAN>
-        {user_question}
-        </PERTANYAAN>
-        [/INST]
-        Jawaban:
-        """,
-                
-                "coverage": f"""
-        [INST]
-        Anda adalah asisten analis perlindungan (coverage) asuransi.
-        Tugas Anda adalah menentukan apakah prosedur pasien DITANGGUNG atau TIDAK DITANGGUNG.
-        1. Periksa <PATIENT_CONTEXT> untuk menemukan prosedur medis yang dijalani pasien (jika ada).
-        2. Periksa <POLICY_CONTEXT> untuk menentukan apakah prosedur tersebut ditanggung.
-        3. Jawab HANYA dengan "DITANGGUNG" atau "TIDAK DITANGGUNG" atau "TIDAK DISEBUTKAN".
-        4. Jika <CONTEXT> menyebutkan syarat, Anda tetap harus menjawab "DITANGGUNG", lalu berikan penjelasan singkat.
-        
-        <POLICY_CONTEXT>
-        {policy_context}
-        </POLICY_CONTEXT>
-        {patient_context}
-        
-        <PERTANYAAN>
-        {user_question}
-        </PERTANYAAN>
-        [/INST]
-        Jawaban:
-        """,
-                
-                "copay": f"""
-        [INST]
-        Anda adalah asisten ekstraksi data keuangan.
-        Tugas Anda adalah menemukan jumlah biaya (co-payment, iuran, deductible).
-        1. Gunakan <POLICY_CONTEXT> untuk menemukan jumlah biaya.
-        2. Gunakan <PATIENT_CONTEXT> untuk mengidentifikasi prosedur yang ditanyakan.
-        3. Jika <POLICY_CONTEXT> tidak menyebutkan biaya spesifik, jawablah "Informasi biaya tidak ditemukan."
-        4. JANGAN membuat kalimat panjang. Berikan jawaban yang spesifik.
-        
-        <POLICY_CONTEXT>
-        {policy_context}
-        </POLICY_CONTEXT>
-        {patient_context}
-        
-        <PERTANYAAN>
-        {user_question}
-        </PERTANYAAN>
-        [/INST]
-        Jawaban:
-        """
-    }
-
-    # 5. Select the correct prompt (unchanged)
-    final_prompt = prompt_templates.get(current_task, prompt_templates["general"])
+    # 4. Keep the static instructions and the per-turn content in
+    #    separate message roles so the instruction prefix stays
+    #    byte-identical across turns (prompt-cache friendly)
+    final_prompt = [
+        {
+            "role": "system",
+            "content": _SYSTEM_INSTRUCTIONS.get(
+                current_task, _SYSTEM_INSTRUCTIONS["general"]
+            ),
+        },
+        {
+            "role": "user",
+            "content": _USER_BLOCK.format(
+                policy_context=policy_context,
+                patient_context=patient_context,
+                user_question=user_question,
+            ),
+        },
+    ]
     
     # 6. Debugging (Updated to show both contexts)
     if st.session_state.debug:
@@ -326,11 +498,18 @@ def create_prompt(user_question):
              st.sidebar.caption("Patient Context (from PDF):")
              st.sidebar.text_area("Patient Context", patient_context, height=150)
         st.sidebar.caption("Final Prompt to LLM:")
-        st.sidebar.text_area("LLM Prompt", final_prompt, height=400)
+        st.sidebar.text_area("LLM Prompt", _prompt_to_text(final_prompt), height=400)
 
     return final_prompt, results
     
 
+@functools.lru_cache(maxsize=256)
+def _parse_iso(s):
+    """Parse an ISO timestamp string, cached since chunks from the same
+    document all carry the same upload date."""
+    return datetime.fromisoformat(s)
+
+
 def format_date_warning(policy_start_date, upload_date):
     """Generates a markdown string for the policy date warning."""
     
@@ -348,7 +527,7 @@ def format_date_warning(policy_start_date, upload_date):
             
             # Convert timestamp string from Snowflake (if needed)
             if isinstance(upload_date, str):
-                upload_date = datetime.fromisoformat(upload_date)
+                upload_date = _parse_iso(upload_date)
 
             upload_date_only = upload_date.date()
             days_ago = (today - upload_date_only).days
@@ -374,38 +553,76 @@ def format_date_warning(policy_start_date, upload_date):
         
     return "" # Default empty string
 
+@st.cache_data(show_spinner=False)
+def _extract_pdf_text(pdf_bytes):
+    """
+    Parse raw PDF bytes and return the extracted text.
+
+    Cached on the hash of the bytes, so reruns with the same uploaded
+    file (every chat input, every toggle) skip the parsing work.
+    """
+    if pdfium is not None:
+        # PDFium decodes text layout in C, ~5-10x faster than PyPDF2
+        pdf = pdfium.PdfDocument(pdf_bytes)
+        return "\n".join(
+            page.get_textpage().get_text_range() for page in pdf
+        )
+
+    pdf_reader = PdfReader(io.BytesIO(pdf_bytes))
+    pages = list(pdf_reader.pages)
+
+    # For long patient reports, extract pages in parallel; below the
+    # threshold the pool overhead outweighs the win
+    if len(pages) > 50:
+        with ThreadPoolExecutor(max_workers=4) as ex:
+            texts = list(ex.map(lambda p: p.extract_text() or "", pages))
+        return "\n".join(texts)
+
+    return "\n".join(page.extract_text() or "" for page in pages)
+
+
+# Reject patient uploads above this size before reading them into memory
+MAX_UPLOAD_BYTES = 20_000_000
+
+
 def get_text_from_uploaded_pdf(uploaded_file):
     """
     Reads an in-memory PDF file and returns its text content.
+
+    Rejects files over MAX_UPLOAD_BYTES up front so a huge upload can't
+    exhaust the container's memory during parsing.
     """
     if uploaded_file is None:
         return ""
-        
+
+    if uploaded_file.size > MAX_UPLOAD_BYTES:
+        st.error(f"PDF too large ({uploaded_file.size / 1_000_000:.0f} MB). Maximum is {MAX_UPLOAD_BYTES // 1_000_000} MB.")
+        return ""
+
     try:
-        # Read the file-like object
-        pdf_content = io.BytesIO(uploaded_file.getvalue())
-        
-        # Use PdfReader to parse the text
-        pdf_reader = PdfReader(pdf_content)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        
-        return text
+        # Pass the raw bytes so st.cache_data can hash them
+        return _extract_pdf_text(uploaded_file.getvalue())
     except Exception as e:
         st.error(f"Error reading uploaded PDF: {e}")
         return ""
 
+ICONS = {"assistant": "❄️", "user": "👤"}
+
+
+def _render_history():
+    """Display chat messages from history on app rerun."""
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"], avatar=ICONS[message["role"]]):
+            st.markdown(message["content"])
+
+
 def main():
     init_config_options()
     init_messages()
 
-    icons = {"assistant": "❄️", "user": "👤"}
+    icons = ICONS
 
-    # Display chat messages from history on app rerun
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"], avatar=icons[message["role"]]):
-            st.markdown(message["content"])
+    _render_history()
 
     # Initialize the task state
     if "current_task" not in st.session_state:
@@ -448,8 +665,11 @@ def main():
         # Display assistant response
         with st.chat_message("assistant", avatar=icons["assistant"]):
             message_placeholder = st.empty()
-            
-            with st.spinner(f"Retrieving context and generating response using {st.session_state.model_name}..."):
+
+            # Route to a task-appropriate model (or the explicit choice)
+            model_name = _resolve_model(st.session_state.get("current_task", "general"))
+
+            with st.spinner(f"Retrieving context and generating response using {model_name}..."):
                 
                 # 1. Create the RAG prompt and retrieve the context results
                 prompt, results = create_prompt(question)
@@ -457,48 +677,54 @@ def main():
                 # Optional: Display full prompt in debug mode
                 if st.session_state.debug:
                     st.sidebar.subheader("Full LLM Prompt (Debug)")
-                    st.sidebar.text_area("LLM Prompt", prompt, height=400)
+                    st.sidebar.text_area("LLM Prompt", _prompt_to_text(prompt), height=400)
 
-                # 2. Call the LLM API
+                # 2. Call the LLM API, streaming tokens into the
+                #    placeholder so the user sees the answer as it is
+                #    generated instead of waiting on the full response
                 try:
-                    generated_response = complete(st.session_state.model_name, prompt)
+                    response_stream = complete(model_name, prompt, stream=True)
+                    generated_response = message_placeholder.write_stream(response_stream)
                 except Exception as e:
                     generated_response = f"Error during LLM completion: {e}"
-
-                # 3. Building Date Warning String
-                date_warning_str = ""
-                if results:
-                    # Get metadata from the first retrieved chunk
-                    # All chunks from the same doc will have the same dates
-                    first_result = results[0]
-                    policy_start = first_result.get('POLICY_START_DATE')
-                    upload_date = first_result.get('UPLOAD_DATE')
-                    
-                    # Generate the warning string using our new function
-                    date_warning_str = format_date_warning(policy_start, upload_date)
-
-                
-                # 4. Build references table for citation
-                markdown_table = "###### Sumber Referensi (References) \n\n| Dokumen | Link | Similarity |\n|-------|-----|------------|\n"
-                
-                if results:
-                    for ref in results:
-                        # Extract the required fields from the search result object
-                        title = ref.get('relative_path', 'N/A')
-                        url = ref.get('file_url', '#')
-                        # Note: @scores is an object, we need to access its sub-key
-                        similarity = ref.get('@scores', {}).get('cosine_similarity', 0.0)
-                        
-                        markdown_table += f"| {title} | [Lihat Dokumen]({url}) | {similarity:.4f} |\n"
-                
-                # 5. Final output
-                final_output = (
-                    f"{generated_response}\n\n"
-                    f"---\n" # Add a horizontal line to break the contents up
-                    f"{date_warning_str}\n"
-                    f"{markdown_table}"
-                )
-                message_placeholder.markdown(final_output)
+                    message_placeholder.markdown(generated_response)
+
+            # The answer is already on screen; build the date warning and
+            # citation table off the critical path and append them after.
+
+            # 3. Building Date Warning String
+            date_warning_str = ""
+            if results:
+                # Get metadata from the first retrieved chunk
+                # All chunks from the same doc will have the same dates
+                first_result = results[0]
+                policy_start = first_result.get('POLICY_START_DATE')
+                upload_date = first_result.get('UPLOAD_DATE')
+
+                # Generate the warning string using our new function
+                date_warning_str = format_date_warning(policy_start, upload_date)
+
+
+            # 4. Build references table for citation
+            #    (one comprehension pass; @scores is an object, so guard
+            #    against it being absent before reading its sub-key)
+            table_header = "###### Sumber Referensi (References) \n\n| Dokumen | Link | Similarity |\n|-------|-----|------------|\n"
+            rows = [
+                f"| {ref.get('relative_path', 'N/A')} "
+                f"| [Lihat Dokumen]({ref.get('file_url', '#')}) "
+                f"| {(ref.get('@scores') or {}).get('cosine_similarity', 0.0):.4f} |"
+                for ref in results
+            ] if results else []
+            markdown_table = table_header + "\n".join(rows)
+
+            # 5. Final output
+            final_output = (
+                f"{generated_response}\n\n"
+                f"---\n" # Add a horizontal line to break the contents up
+                f"{date_warning_str}\n"
+                f"{markdown_table}"
+            )
+            message_placeholder.markdown(final_output)
         
         # 6. Add assistant response to history
         st.session_state.messages.append(